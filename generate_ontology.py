@@ -1,14 +1,31 @@
 import argparse
+import asyncio
+import email.utils
+import functools
+import hashlib
+import math
 import os
-import re
 import sys
+import tempfile
+import threading
+import time
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, OpenAI
 from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
 from pyparsing.helpers import Iterable
-
-from validator import log_report, validate_ttl, validate_with_competency_questions_file
+from rdflib import Graph
+
+from validator import (
+    load_competency_questions,
+    load_graph,
+    emit_log,
+    log_report,
+    new_graph,
+    parse_turtle,
+    ttl_sha256,
+    validate_graph,
+)
 
 load_dotenv()
 
@@ -19,6 +36,19 @@ LLM_BASE_URL = os.getenv("LLM_BASE_URL")
 LLM_MODEL = os.getenv("LLM_MODEL")
 LLM_API_KEY = os.getenv("LLM_API_KEY")
 
+# Transient API failures (connection errors, 408/409/429 and 5xx responses)
+# are retried with exponential backoff (1s .. 30s), or after the delay the
+# server asks for in `Retry-After`
+LLM_MAX_ATTEMPTS = 4
+LLM_MAX_BACKOFF = 30
+LLM_RETRY_STATUSES = (408, 409, 429)
+
+# Upper bound on concurrent fix candidates per fix step
+LLM_MAX_FIX_CANDIDATES = 3
+
+# Responses are cached on disk keyed by (model, system prompt, user prompt)
+LLM_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "llm_owl")
+
 prefix_part = """# Prefixes
 @prefix : <http://example.org/highway_code#> .
 @prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
@@ -26,25 +56,170 @@ prefix_part = """# Prefixes
 @prefix owl: <http://www.w3.org/2002/07/owl#> .
 @prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
 """
+generated_header = "\n\n# Generated code\n\n"
+# Everything written before the generated Turtle, concatenated and encoded once
+ttl_header = prefix_part + generated_header
+TTL_HEADER_BYTES = ttl_header.encode("utf-8")
+
+# Language tags accepted on the fenced block holding the Turtle
+TTL_FENCE_TAGS = ("ttl", "turtle", "")
 
 
 def get_client():
     """Get or initialize the OpenAI client configured for local LLM."""
     global client
     if client is None:
-        client = OpenAI(base_url=LLM_BASE_URL, api_key=LLM_API_KEY)
+        # Retries (including 408/409/5xx and Retry-After) are handled by
+        # `_create_completion`
+        client = OpenAI(base_url=LLM_BASE_URL, api_key=LLM_API_KEY, max_retries=0)
     return client
 
 
+@functools.lru_cache(maxsize=8)
 def load_system_prompt(path="system_step-by-step.md"):
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
 
-def call_llm(system_prompt, text, dest, model=None):
-    client = get_client()
-    model = model or os.getenv("LLM_MODEL", "gpt-4o-mini")
-    messages: Iterable[ChatCompletionMessageParam] = [
+def _cache_path(model, system_prompt, user_prompt):
+    key = hashlib.sha256(
+        (model + "\x00" + system_prompt + "\x00" + user_prompt).encode("utf-8")
+    ).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, key + ".md")
+
+
+def _ttl_block_start(content, start=0):
+    """Return where the body of the first Turtle fenced block begins, or -1.
+
+    Fenced blocks with other language tags (e.g. the JSON part) are skipped.
+    -1 is also returned when the opening fence line is not complete yet.
+    """
+    j = content.find("```", start)
+    while j >= 0:
+        k = content.find("\n", j)
+        if k < 0:
+            return -1
+        if content[j + 3 : k].strip().lower() in TTL_FENCE_TAGS:
+            return k + 1
+        end = content.find("\n```", k)
+        if end < 0:
+            return -1
+        j = content.find("```", end + 4)
+    return -1
+
+
+class OwlStreamSplitter:
+    """Incrementally extract the Turtle block of a streamed LLM response.
+
+    Text deltas are fed as they arrive. As soon as the fenced block following
+    `## OWL` is closed, the Turtle (with `prefix` prepended) is parsed in a
+    background thread while the LLM keeps emitting the rest of the response.
+    """
+
+    PRE_OWL, PRE_FENCE, IN_FENCE, POST_FENCE = range(4)
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.state = self.PRE_OWL
+        self.ttl = ""
+        # Only the not yet consumed tail of the response is kept here
+        self._buffer = ""
+        self._scanned = 0
+        self._graph = None
+        self._thread = None
+
+    def feed(self, delta):
+        if self.state == self.POST_FENCE:
+            return
+        self._buffer += delta
+        if self.state == self.PRE_OWL:
+            i = self._buffer.find("## OWL")
+            if i < 0:
+                self._buffer = self._buffer[-(len("## OWL") - 1) :]
+                return
+            self._buffer = self._buffer[i + len("## OWL") :]
+            self.state = self.PRE_FENCE
+        if self.state == self.PRE_FENCE:
+            body = _ttl_block_start(self._buffer)
+            if body < 0:
+                return
+            self._buffer = self._buffer[body:]
+            self.state = self.IN_FENCE
+        # The block body must be non-empty, so the closing fence can't start
+        # at offset 0
+        end = self._buffer.find("\n```", max(1, self._scanned - 3))
+        if end < 0:
+            self._scanned = len(self._buffer)
+            return
+        self.ttl = self._buffer[:end].strip()
+        self._buffer = ""
+        self.state = self.POST_FENCE
+        self._thread = threading.Thread(target=self._parse, daemon=True)
+        self._thread.start()
+
+    def _parse(self):
+        g = new_graph()
+        try:
+            parse_turtle(g, data=self.prefix + self.ttl)
+        except Exception:
+            return
+        self._graph = g
+
+    def graph(self) -> Graph | None:
+        """Wait for the background parse and return its graph, if valid."""
+        if self._thread is None:
+            return None
+        self._thread.join()
+        return self._graph
+
+
+def _retry_after(e):
+    # Seconds requested by `Retry-After(-ms)` on an error response, if any
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    for header, divisor in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(float(value) / divisor, 0)
+        except ValueError:
+            pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(headers.get("retry-after", ""))
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        return None
+    return max(retry_date.timestamp() - time.time(), 0)
+
+
+def _is_retryable(e):
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and (
+        e.status_code in LLM_RETRY_STATUSES or e.status_code >= 500
+    )
+
+
+def _create_completion(client, **kwargs):
+    for attempt in range(LLM_MAX_ATTEMPTS):
+        try:
+            return client.chat.completions.create(**kwargs)
+        except (APIConnectionError, APIStatusError) as e:
+            if not _is_retryable(e) or attempt == LLM_MAX_ATTEMPTS - 1:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(2**attempt, LLM_MAX_BACKOFF)
+            print(f"LLM call failed ({e}); retrying in {delay}s...")
+            time.sleep(delay)
+
+
+def _build_messages(system_prompt, text) -> Iterable[ChatCompletionMessageParam]:
+    return [
         {"role": "system", "content": system_prompt},
         {
             "role": "user",
@@ -58,95 +233,247 @@ def call_llm(system_prompt, text, dest, model=None):
         },
     ]
 
-    with open(os.path.join(dest, "LLM_prompt.md"), "a+", encoding="utf-8") as f:
-        for msg in messages:
-            f.write(f"# {msg['role'].upper()}\n{msg['content']}\n\n")
 
-    resp = client.chat.completions.create(
-        model=model, messages=messages# temperature=0.0, max_tokens=4000
-    )
-    return resp.choices[0].message.content
+def discard_cached_response(system_prompt, text, model=None):
+    """Remove the cached response for a prompt, e.g. after it failed validation."""
+    model = model or os.getenv("LLM_MODEL", "gpt-4o-mini")
+    messages = _build_messages(system_prompt, text)
+    cache_path = _cache_path(model, system_prompt, messages[1]["content"])
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
 
 
-def split_response(content):
-    splitter = "## OWL"
-    if splitter in content:
-        left, right = content.split(splitter, 1)
-        # return left.strip(), right.strip()
-        code_block_match = re.search(
-            r"```(?:ttl|turtle)\n([\s\S]+?)\n```", right.strip(), re.IGNORECASE
-        )
-        if code_block_match:
-            # Assume JSON is before code block
-            # parts = re.split(r"```(?:json)?\n[\s\S]+?\n```", content)
-            # # fallback: take first JSON-like and the code block
-            # json_part = parts[0].strip()
-            ttl_part = code_block_match.group(1).strip()
-            return ttl_part
-    return ""
+def call_llm(system_prompt, text, dest, model=None, use_cache=True):
+    client = get_client()
+    model = model or os.getenv("LLM_MODEL", "gpt-4o-mini")
+    messages = _build_messages(system_prompt, text)
 
+    # Build the whole prompt log first so it is appended with a single write
+    prompt_log = "".join(
+        f"# {msg['role'].upper()}\n{msg['content']}\n\n" for msg in messages
+    )
+    with open(
+        os.path.join(dest, "LLM_prompt.md"), "a", encoding="utf-8", buffering=1 << 20
+    ) as f:
+        f.write(prompt_log)
+
+    splitter = OwlStreamSplitter(prefix=ttl_header)
+    cache_path = _cache_path(model, system_prompt, messages[1]["content"])
+    if use_cache and os.path.exists(cache_path):
+        print("Using cached LLM response:", cache_path)
+        with open(cache_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        splitter.feed(content)
+        return content, splitter
+
+    resp = _create_completion(
+        client, model=model, messages=messages, stream=True# temperature=0.0, max_tokens=4000
+    )
+    parts = []
+    for chunk in resp:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            splitter.feed(delta)
+    content = "".join(parts)
+
+    if use_cache and content:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    return content, splitter
 
-def save_outputs(json_text, ttl_text, dest="dest", out_prefix="output"):
+
+def split_response(content):
+    # Legacy fallback; streamed responses are split by `OwlStreamSplitter`
+    i = content.find("## OWL")
+    if i < 0:
+        return ""
+    body = _ttl_block_start(content, i + len("## OWL"))
+    if body < 0:
+        return ""
+    end = content.find("\n```", body + 1)
+    if end < 0:
+        return ""
+    return content[body:end].strip()
+
+
+def save_outputs(json_text, ttl_body, dest="dest", out_prefix="output"):
     jpath = os.path.join(dest, f"{out_prefix}.md")
     tpath = os.path.join(dest, f"{out_prefix}.ttl")
     with open(jpath, "w", encoding="utf-8") as f:
         f.write(json_text)
-    with open(tpath, "w", encoding="utf-8") as f:
-        f.write(ttl_text)
+    with open(tpath, "wb") as f:
+        # Header and body are written separately rather than joined first
+        f.write(TTL_HEADER_BYTES)
+        f.write(ttl_body.encode("utf-8"))
     return jpath, tpath
 
 
-def validate_output(tpath: str, dest: str) -> str | None:
+def check_output(tpath: str, g: Graph | None = None):
+    """Validate a generated TTL file, parsing it unless `g` is given.
+
+    Returns the consistency errors (None if the reasoner could not run) and
+    the CQ validation result (see `validate_graph`), or None when the Turtle
+    is invalid.
+    """
     print("Validating Turtle file:", tpath)
-    if not validate_ttl(tpath):
+    if g is not None:
+        # Already parsed while the LLM response was streaming
+        emit_log("ttl_valid", path=tpath)
+    else:
+        g = load_graph(tpath)
+    if g is None:
         print("Generated Turtle file is invalid.")
-        return "Failed to load Turtle file."
+        return None
     print("Turtle syntax is valid.")
-    success, cq_validation = validate_with_competency_questions_file(
-        tpath, "cqs_example.json"
+    return validate_graph(
+        g, load_competency_questions("cqs_example.json"), ttl_hash=ttl_sha256(tpath)
     )
-    if not success:
+
+
+def report_output(result, dest: str) -> str | None:
+    """Report a `check_output` result, writing the CQ report into `dest`.
+
+    Returns the error message to put in a fix prompt, or None if the output
+    passed every check.
+    """
+    if result is None:
+        return "Failed to load Turtle file."
+    consistency_errors, (success, cq_validation) = result
+    if consistency_errors is None:
+        # Nothing the LLM can fix, so warn and judge the output by its CQs
+        print("Warning: the consistency check could not run; skipping it.")
+    if not consistency_errors and success:
+        print("All competency questions passed.")
+        return None
+    # Both checks already ran, so report every problem in one fix prompt
+    error_lines = []
+    if consistency_errors:
+        print("The ontology is not consistent.")
+        error_lines.extend(consistency_errors)
+    if success:
+        print("All competency questions passed.")
+    else:
         print("Some competency questions failed.")
-        error_msg = log_report(cq_validation, dest)
-        print(error_msg)
-        return error_msg
-    print("All competency questions passed.")
-    return None
+    error_lines.append(log_report(cq_validation, dest))
+    error_msg = "\n".join(error_lines)
+    print(error_msg)
+    return error_msg
+
+
+def validate_output(tpath: str, dest: str, g: Graph | None = None) -> str | None:
+    return report_output(check_output(tpath, g), dest)
     # if not validate_with_competency_questions_file(tpath, "cqs_example.json"):
     #     print("Some competency questions failed.")
     #     exit(-1)
     # print("All validations passed.")
 
 
+def _count_failures(result) -> float:
+    # Number of problems in a `check_output` result; invalid Turtle is worst
+    if result is None:
+        return math.inf
+    consistency_errors, (_, cq_validation) = result
+    summary = cq_validation["summary"]
+    return len(consistency_errors or ()) + summary["total"] - summary["passed"]
+
+
+def _failed_question_sections(error_msg):
+    # The per-question blocks of a CQ report, as produced by `log_report`
+    return [
+        "- Question ID:" + section
+        for section in error_msg.split("\n- Question ID:")[1:]
+    ]
+
+
+async def _call_llm_concurrently(system_prompt, user_prompts, dest):
+    return await asyncio.gather(
+        *(
+            asyncio.to_thread(
+                call_llm,
+                system_prompt,
+                user_prompt,
+                dest,
+                model=LLM_MODEL,
+                # A retried fix prompt must get a fresh answer, not the one
+                # that just failed validation
+                use_cache=False,
+            )
+            for user_prompt in user_prompts
+        ),
+        return_exceptions=True,
+    )
+
+
 def llm_fix_and_validate(content, dest, error_msg, step=0, max_steps=3):
     print(f"LLM fix step {step}...")
     # system_prompt = load_system_prompt("system_fixing.md")
     system_prompt = """
 Your task is to fix the provided OWL Turtle code based on the following error message from a validator:"""
-    user_prompt = f"""
+    # With several failed CQs, concurrent candidates each get the full report
+    # but focus on a different failure. Every candidate is validated with its
+    # own Pellet worker process, so their number is capped.
+    sections = _failed_question_sections(error_msg)
+    if len(sections) > 1:
+        focuses = [
+            f"Focus on fixing this issue first:\n{section}\n"
+            for section in sections[:LLM_MAX_FIX_CANDIDATES]
+        ]
+    else:
+        focuses = [""]
+    user_prompts = [
+        f"""
 Here is the original Turtle code:
 {content}
 The Turtle code has the following issues:
 {error_msg}
-Please provide a corrected version of the OWL Turtle code that resolves these issues.
+{focus}Please provide a corrected version of the OWL Turtle code that resolves these issues.
 """
-    try:
-        fixed_content = call_llm(system_prompt, user_prompt, dest, model=LLM_MODEL)
-    except Exception as e:
-        print("LLM call failed during fixing:", str(e))
+        for focus in focuses
+    ]
+    # A failed candidate is dropped; only give up when every call failed
+    responses = []
+    for result in asyncio.run(
+        _call_llm_concurrently(system_prompt, user_prompts, dest)
+    ):
+        if isinstance(result, BaseException):
+            print("LLM call failed during fixing:", str(result))
+        else:
+            responses.append(result)
+    if not responses:
         sys.exit(1)
 
-    print("LLM fix response received.")
-
-    ttl_part = f"{prefix_part}\n\n# Generated code\n\n{split_response(fixed_content)}"
-
-    jpath, tpath = save_outputs(fixed_content, ttl_part, dest=dest, out_prefix="fixed_output")
-    print("Saved fixed output to:", jpath)
-    if not ttl_part:
-        print("No OWL Turtle detected in fixed response; check the raw output below:\n")
-    else:
-        print("Saved fixed OWL Turtle to:", tpath)
-    error_msg = validate_output(tpath, dest)
+    print(f"LLM fix response received ({len(responses)} candidates).")
+
+    # Stop at the first candidate that passes, otherwise keep the one with
+    # the fewest failures
+    best = None
+    for fixed_content, splitter in responses:
+        ttl_body = splitter.ttl or split_response(fixed_content)
+
+        jpath, tpath = save_outputs(fixed_content, ttl_body, dest=dest, out_prefix="fixed_output")
+        print("Saved fixed output to:", jpath)
+        if not ttl_body:
+            print("No OWL Turtle detected in fixed response; check the raw output below:\n")
+        else:
+            print("Saved fixed OWL Turtle to:", tpath)
+        result = check_output(tpath, splitter.graph())
+        failures = _count_failures(result)
+        if best is None or failures < best[0]:
+            best = (failures, fixed_content, ttl_body, result)
+        if failures == 0:
+            break
+    _, best_content, ttl_body, result = best
+    if best_content is not fixed_content:
+        # A later, worse candidate overwrote the best one on disk
+        save_outputs(best_content, ttl_body, dest=dest, out_prefix="fixed_output")
+        fixed_content = best_content
+    error_msg = report_output(result, dest)
     if error_msg and step < max_steps:
         step += 1
         print("Recursively calling LLM to fix issues...")
@@ -167,25 +494,34 @@ def llm_setup_and_validate(args):
 
     system_prompt = load_system_prompt(args.system)
     try:
-        content = call_llm(system_prompt, text, dest=args.dest, model=args.model)
+        content, splitter = call_llm(
+            system_prompt,
+            text,
+            dest=args.dest,
+            model=args.model,
+            use_cache=not args.no_cache,
+        )
     except Exception as e:
         print("LLM call failed:", str(e))
         sys.exit(1)
 
     print("LLM response received: ", content)
 
-    ttl_part = f"{prefix_part}\n\n# Generated code\n\n{split_response(content)}"
+    ttl_body = splitter.ttl or split_response(content)
 
-    jpath, tpath = save_outputs(content, ttl_part, dest=args.dest, out_prefix=args.name)
+    jpath, tpath = save_outputs(content, ttl_body, dest=args.dest, out_prefix=args.name)
     print("Saved output to:", jpath)
-    if not ttl_part:
+    if not ttl_body:
         print("No OWL Turtle detected in response; check the raw output below:\n")
     else:
         print("Saved OWL Turtle to:", tpath)
-    error_msg = validate_output(tpath, args.dest)
+    error_msg = validate_output(tpath, args.dest, splitter.graph())
+    if error_msg:
+        # Don't serve a response that failed validation to later runs
+        discard_cached_response(system_prompt, text, model=args.model)
     if error_msg and args.recursive:
         print("Recursively calling LLM to fix issues...")
-        llm_fix_and_validate(ttl_part, args.dest, error_msg)
+        llm_fix_and_validate(ttl_header + ttl_body, args.dest, error_msg)
 
 
 def main():
@@ -218,18 +554,28 @@ def main():
         action="store_true",
         help="Recursively validate until all CQs pass",
     )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the LLM instead of reusing cached responses",
+    )
     args = p.parse_args()
 
     if not args.dest:
         args.dest = os.path.join("dest", f"dest_{LLM_MODEL}_{args.name}")
     if os.path.exists(args.dest) and not args.validate_only:
-        # If the destination exists, create a new unique folder
-        base_dest = args.dest
-        i = 1
-        while os.path.exists(args.dest):
-            args.dest = f"{base_dest}_{i}"
-            i += 1
-        
+        # If the destination exists, atomically create a new unique folder
+        # next to it
+        base_dest = os.path.normpath(args.dest)
+        args.dest = tempfile.mkdtemp(
+            prefix=f"{os.path.basename(base_dest)}_", dir=os.path.dirname(base_dest)
+        )
+        # mkdtemp creates the folder as 0700; give it the umask default that
+        # os.makedirs would have used so outputs stay readable by others
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(args.dest, 0o777 & ~umask)
+
     os.makedirs(args.dest, exist_ok=True)
 
     if not args.validate_only:
@@ -1,59 +1,165 @@
 import argparse
+import atexit
+import functools
+import hashlib
+import io
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, UTC
-from typing import Any, Dict, List, Optional
+from typing import Any, Collection, Dict, List, Optional
 
 import owlready2
 import yaml
 from rdflib import Graph
+from rdflib.plugins.sparql import prepareQuery
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib encoder
+    orjson = None
+
+try:
+    from oxrdflib import OxigraphStore
+except ImportError:  # optional, falls back to rdflib's in-memory store
+    OxigraphStore = None
 
 # Module-level logger (can be configured in `main`)
 LOG: logging.Logger = logging.getLogger("owl_llm.validator")
 LOG.addHandler(logging.NullHandler())
+# Background thread writing queued log records to the structured log file
+_LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+
+# Entries of passing CQs keyed by (the CQ's public fields, sha256 of the TTL),
+# so the recursive fix loop doesn't rerun them on an unchanged ontology.
+# Failures are never cached since they have to be re-evaluated after each fix.
+_cq_pass_cache: Dict[tuple[str, str], Dict[str, Any]] = {}
+
+# A bare `ASK [WHERE] { ... }` query whose body can be fused with others
+_ASK_QUERY = re.compile(r"\s*ASK\s*(?:WHERE\s*)?\{(.*)\}\s*", re.IGNORECASE | re.DOTALL)
+
+
+def _dumps(obj: Any, indent: bool = False) -> bytes:
+    # Serialize to UTF-8 JSON, using orjson when it is installed
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode(
+        "utf-8"
+    )
+
+
+def new_graph() -> Graph:
+    """Create an empty Graph, backed by Oxigraph when oxrdflib is installed."""
+    if OxigraphStore is not None:
+        return Graph(store="Oxigraph")
+    return Graph()
+
+
+def _native_sparql(g: Graph) -> bool:
+    # Oxigraph evaluates SPARQL strings natively, whereas prepared queries are
+    # routed through rdflib's pure-Python evaluator
+    return OxigraphStore is not None and isinstance(g.store, OxigraphStore)
+
+
+# `@prefix p: <iri> .` / `PREFIX p: <iri>` directives of a Turtle document
+_TURTLE_PREFIX = re.compile(
+    r"^\s*(?:@prefix|PREFIX)\s+([^\s:]*):\s*<([^>]*)>", re.IGNORECASE | re.MULTILINE
+)
+
+
+def parse_turtle(
+    g: Graph, source: Optional[str] = None, data: Optional[str] = None
+) -> Graph:
+    """Parse Turtle from a file path (`source`) or a string (`data`) into `g`.
+
+    Oxigraph-backed graphs use Oxigraph's native parser. Unlike rdflib's, it
+    doesn't bind the document's prefixes to the graph, so they are bound here
+    for queries relying on them.
+    """
+    if not _native_sparql(g):
+        return g.parse(source=source, data=data, format="turtle")
+    g.parse(source=source, data=data, format="ox-turtle")
+    if data is None:
+        with open(source, "r", encoding="utf-8") as f:
+            data = f.read()
+    for prefix, iri in _TURTLE_PREFIX.findall(data):
+        g.bind(prefix, iri, override=True)
+    return g
 
 
 def _row_to_string(row) -> str:
-    # Convert a SPARQL result row to a simple string representation
-    if hasattr(row, "asdict"):
-        d = row.asdict()
-        # join values by pipe for deterministic comparison
-        return "|".join(str(v) for v in d.values())
-    # fallback for tuple-like rows
-    try:
-        return "|".join(str(x) for x in row)
-    except Exception:
-        return str(row)
+    # Convert a SPARQL result row (a `ResultRow` tuple) to a simple string
+    # representation; values are joined by pipe for deterministic comparison.
+    # Unbound variables (None) are skipped, as `ResultRow.asdict` would.
+    return "|".join([str(v) for v in row if v is not None])
 
 
-def validate_ttl(ttl_path: str) -> bool:
-    """Validate a Turtle/TTL file for syntax correctness."""
-    g = Graph()
-    with open(ttl_path, "r", encoding="utf-8") as f:
-        ttl_text = f.read()
+def load_graph(ttl_path: str) -> Graph | None:
+    """Parse a Turtle/TTL file into a Graph, or return None if it is invalid.
+
+    The returned graph is meant to be shared by the consistency check and the
+    competency question validation so the file is only parsed once.
+    """
+    g = new_graph()
     try:
-        g.parse(data=ttl_text, format="turtle")
-        emit_log("ttl_valid", path=ttl_path)
-        return True
+        parse_turtle(g, source=ttl_path)
     except Exception as e:
         print("Turtle validation error:", str(e))
         emit_log("ttl_invalid", path=ttl_path, error=str(e))
-        return False
+        return None
+    emit_log("ttl_valid", path=ttl_path)
+    return g
 
 
-def check_consistency(ontology: Graph) -> list[str]:
-    """Check if an OWL ontology is internally consistent."""
+def validate_ttl(ttl_path: str) -> bool:
+    """Validate a Turtle/TTL file for syntax correctness."""
+    return load_graph(ttl_path) is not None
+
+
+_OWL_IMPORTS_NT = b"<http://www.w3.org/2002/07/owl#imports>"
+
+
+def _drop_owl_imports(ntriples: bytes) -> bytes:
+    # owlready2's loader follows owl:imports (and fails on unreachable IRIs),
+    # whereas only the ontology itself is meant to be reasoned over. In
+    # N-Triples the subject never contains a space, so the predicate is the
+    # second space-separated field of each line.
+    return b"\n".join(
+        line
+        for line in ntriples.splitlines()
+        if line.split(b" ", 2)[1:2] != [_OWL_IMPORTS_NT]
+    )
+
+
+def _run_reasoner(ntriples: bytes) -> tuple[bool, str]:
+    """Run Pellet on an ontology serialized as N-Triples.
+
+    Returns whether the ontology is consistent and the comma-separated names
+    of its inconsistent classes. Kept free of logging so it can run in a
+    worker process.
+    """
     world = owlready2.World()
-    graph = world.as_rdflib_graph()
-    with world.get_ontology("http://localhost/"):
-        graph += ontology
+    # Bulk-load through owlready2's native N-Triples parser rather than
+    # copying the triples one by one into its rdflib view
+    world.get_ontology("http://localhost/").load(
+        fileobj=io.BytesIO(_drop_owl_imports(ntriples)), format="ntriples"
+    )
     try:
         owlready2.sync_reasoner_pellet(world, debug=0)
     except owlready2.OwlReadyInconsistentOntologyError:
+        return False, ""
+    return True, ", ".join(c.__name__ for c in world.inconsistent_classes())
+
+
+def _consistency_errors(consistent: bool, inconsistent_classes: str) -> list[str]:
+    if not consistent:
         emit_log("consistency_error", error="OwlReadyInconsistentOntologyError")
         return ["The ontology is inconsistent"]
-    inconsistent_classes = ", ".join(c.__name__ for c in world.inconsistent_classes())
     if inconsistent_classes:
         emit_log("consistency_issues", inconsistent_classes=inconsistent_classes)
         return [
@@ -63,25 +169,52 @@ def check_consistency(ontology: Graph) -> list[str]:
     return []
 
 
+def check_consistency(ontology: Graph) -> list[str]:
+    """Check if an OWL ontology is internally consistent."""
+    ntriples = ontology.serialize(format="nt", encoding="utf-8")
+    return _consistency_errors(*_run_reasoner(ntriples))
+
+
 def setup_structured_logger(path: str) -> logging.Logger:
     """Create a logger that writes JSON lines to `path`.
 
-    Each log entry will be a single JSON object per line.
+    Each log entry will be a single JSON object per line. Records are only
+    queued by the caller; a `QueueListener` thread does the file writes.
     """
+    global _LOG_LISTENER
     logger = logging.getLogger("owl_llm.validator")
     logger.setLevel(logging.INFO)
     # remove existing handlers
     for h in list(logger.handlers):
         logger.removeHandler(h)
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        for h in _LOG_LISTENER.handlers:
+            h.close()
 
     fh = logging.FileHandler(path, encoding="utf-8")
     fh.setLevel(logging.INFO)
     # Keep message raw (we log JSON ourselves)
     fh.setFormatter(logging.Formatter("%(message)s"))
-    logger.addHandler(fh)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _LOG_LISTENER = logging.handlers.QueueListener(
+        log_queue, fh, respect_handler_level=True
+    )
+    _LOG_LISTENER.start()
     return logger
 
 
+def _stop_log_listener() -> None:
+    # Drain the queue before the interpreter exits
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+
+
+atexit.register(_stop_log_listener)
+
+
 def emit_log(stage: str, **fields: Any) -> None:
     """Emit a structured JSON-line log entry using the module `LOG`.
 
@@ -92,7 +225,7 @@ def emit_log(stage: str, **fields: Any) -> None:
     payload = {"timestamp": datetime.now(UTC).isoformat() + "Z", "stage": stage}
     payload.update(fields)
     # try:
-    LOG.info(json.dumps(payload, ensure_ascii=False))#, indent=4))
+    LOG.info(_dumps(payload).decode("utf-8"))#, indent=4))
     # except Exception:
     #     try:
     #         # Last resort: print the JSON payload
@@ -102,13 +235,27 @@ def emit_log(stage: str, **fields: Any) -> None:
     #         pass
 
 
+def ttl_sha256(ttl_path: str) -> str:
+    """Return the SHA-256 hex digest of a TTL file's content."""
+    with open(ttl_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_competency_questions(cq_file: str) -> List[Dict[str, Any]]:
+    """Load competency questions from `cq_file` with their queries prepared."""
+    return _prepare_competency_questions(_load_json(cq_file))
+
+
 def validate_with_competency_questions_file(
     ttl_file: str, cq_file: str
 ) -> tuple[bool, Dict[str, Any]]:
-    ttl_text = open(ttl_file, "r", encoding="utf-8").read()
-    cqs = _load_json(cq_file)
+    g = new_graph()
+    parse_turtle(g, source=ttl_file)
+    cqs = load_competency_questions(cq_file)
 
-    return validate_with_competency_questions(ttl_text, cqs)
+    return validate_with_competency_questions_graph(
+        g, cqs, ttl_hash=ttl_sha256(ttl_file)
+    )
 
 
 def validate_with_competency_questions(
@@ -116,6 +263,24 @@ def validate_with_competency_questions(
 ) -> tuple[bool, Dict[str, Any]]:
     """Validate an OWL/Turtle string against competency questions.
 
+    See `validate_with_competency_questions_graph` for the CQ format.
+    """
+    g = new_graph()
+    parse_turtle(g, data=ttl_text)
+    ttl_hash = hashlib.sha256(ttl_text.encode("utf-8")).hexdigest()
+
+    return validate_with_competency_questions_graph(
+        g, competency_questions, ttl_hash=ttl_hash
+    )
+
+
+def validate_with_competency_questions_graph(
+    g: Graph,
+    competency_questions: List[Dict[str, Any]],
+    ttl_hash: Optional[str] = None,
+) -> tuple[bool, Dict[str, Any]]:
+    """Validate an already parsed graph against competency questions.
+
     Each competency question is a dict with keys:
       - id: optional identifier
       - sparql: the SPARQL ASK/SELECT query to run against the graph
@@ -125,21 +290,49 @@ def validate_with_competency_questions(
           the question passes when the query returns at least one row (or
           True for ASK).
 
+    `ttl_hash` identifies the TTL the graph was parsed from (see
+    `ttl_sha256`). When given, questions that already passed against the same
+    TTL are reported from cache instead of being run again.
+
     Returns a report dict with per-question results and a summary.
     """
-    g = Graph()
-    g.parse(data=ttl_text, format="turtle")
-
     results: List[Dict[str, Any]] = []
     passed_count = 0
+    competency_questions = _prepare_competency_questions(competency_questions)
 
     # Log start of validation run
     emit_log("CQ_validation_start", total_questions=len(competency_questions))
 
-    for cq in competency_questions:
-        output = validate_with_competency_question(g, cq, results)
+    done: Dict[int, Dict[str, Any]] = {}
+    if ttl_hash is not None:
+        for i, cq in enumerate(competency_questions):
+            cached = _cq_pass_cache.get(_cq_cache_key(cq, ttl_hash))
+            if cached is not None:
+                done[i] = dict(cached, cached=True)
+
+    # Plain ASK questions are answered together by one fused query; whatever
+    # it doesn't cover is validated individually below
+    done.update(_validate_fused_ask_questions(g, competency_questions, exclude=done))
+
+    # Queries are independent and read-only, so run them concurrently against
+    # the same graph; `map` yields the outputs back in input order.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        outputs = list(
+            executor.map(
+                lambda i: done[i]
+                if i in done
+                else validate_with_competency_question(
+                    g, competency_questions[i], results
+                ),
+                range(len(competency_questions)),
+            )
+        )
+
+    for cq, output in zip(competency_questions, outputs):
         if output and output.get("passed", True):
             passed_count += 1
+            if ttl_hash is not None and not output.get("cached"):
+                _cq_pass_cache[_cq_cache_key(cq, ttl_hash)] = output
         results.append(output)
 
         # Log each question's result as a structured JSON line
@@ -163,22 +356,130 @@ def validate_with_competency_questions(
     return passed_count == len(competency_questions), output
 
 
+def validate_graph(
+    g: Graph,
+    competency_questions: List[Dict[str, Any]],
+    ttl_hash: Optional[str] = None,
+) -> tuple[Optional[list[str]], tuple[bool, Dict[str, Any]]]:
+    """Check consistency and competency questions of a graph concurrently.
+
+    The reasoner (Pellet, which spawns a JVM) runs in a worker process while
+    the competency questions are evaluated here against `g`, so the total
+    time is that of the slower of the two. Returns the `check_consistency`
+    errors, or None if the reasoner itself could not run, and the
+    `validate_with_competency_questions_graph` result.
+    """
+    ntriples = g.serialize(format="nt", encoding="utf-8")
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        reasoning = executor.submit(_run_reasoner, ntriples)
+        cq_result = validate_with_competency_questions_graph(
+            g, competency_questions, ttl_hash=ttl_hash
+        )
+        try:
+            consistency_errors = _consistency_errors(*reasoning.result())
+        except Exception as e:
+            # e.g. no `java` on PATH: a problem with the environment rather
+            # than the ontology, so keep it apart from the consistency errors
+            emit_log("consistency_check_failed", error=str(e))
+            consistency_errors = None
+    return consistency_errors, cq_result
+
+
+def _cq_entry(cq: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": cq.get("id") or cq.get("name") or "unnamed",
+        "sparql": cq.get("sparql", ""),
+        "expected": cq.get("expected", None),
+        "question": cq.get("question", ""),
+    }
+
+
+def _ask_entry(entry: Dict[str, Any], actual_bool: bool) -> Dict[str, Any]:
+    expected = entry["expected"]
+    passed = True if expected is None and actual_bool else (expected == actual_bool)
+    entry.update({"passed": passed, "actual": actual_bool})
+    return entry
+
+
+def _fused_ask_sparql(bodies: tuple[str, ...]) -> str:
+    # One `BIND(EXISTS { ... } AS ?qN)` per ASK body, evaluated in a single row.
+    # Later EXISTS see the earlier ?qN bound, so the prefix of the binding
+    # names is grown until no body mentions a variable starting with it.
+    prefix = "q"
+    while any(re.search(rf"[?$]{prefix}\d", body) for body in bodies):
+        prefix += "_"
+    binds = "\n".join(
+        f"BIND(EXISTS {{\n{body}\n}} AS ?{prefix}{i})"
+        for i, body in enumerate(bodies)
+    )
+    variables = " ".join(f"?{prefix}{i}" for i in range(len(bodies)))
+    return f"SELECT {variables} WHERE {{\n{binds}\n}}"
+
+
+@functools.lru_cache(maxsize=16)
+def _fused_ask_query(bodies: tuple[str, ...]):
+    return prepareQuery(_fused_ask_sparql(bodies))
+
+
+def _cq_cache_key(cq: Dict[str, Any], ttl_hash: str) -> tuple[str, str]:
+    # Everything that goes into the result entry, canonicalized, so editing
+    # e.g. only `expected` never serves a stale pass
+    fields = json.dumps(_cq_entry(cq), sort_keys=True, default=str)
+    return fields, ttl_hash
+
+
+def _validate_fused_ask_questions(
+    g: Graph,
+    competency_questions: List[Dict[str, Any]],
+    exclude: Collection[int] = (),
+) -> Dict[int, Dict[str, Any]]:
+    """Answer all fuseable ASK questions with a single SELECT query.
+
+    Questions whose index is in `exclude` are skipped. Returns the result
+    entries keyed by the question's index. Questions that are missing
+    (nothing to fuse, the fused query failed, or its EXISTS errored) are left
+    to `validate_with_competency_question`.
+    """
+    indices = [
+        i
+        for i, cq in enumerate(competency_questions)
+        if cq.get("_ask_body") is not None and i not in exclude
+    ]
+    if len(indices) < 2:
+        return {}
+    bodies = tuple(competency_questions[i]["_ask_body"] for i in indices)
+    try:
+        if _native_sparql(g):
+            query = _fused_ask_sparql(bodies)
+        else:
+            query = _fused_ask_query(bodies)
+        row = next(iter(g.query(query)))
+    except Exception:
+        return {}
+
+    fused: Dict[int, Dict[str, Any]] = {}
+    for i, value in zip(indices, row):
+        if value is not None:
+            entry = _cq_entry(competency_questions[i])
+            fused[i] = _ask_entry(entry, bool(value.toPython()))
+    return fused
+
+
 def validate_with_competency_question(
     g: Graph, cq: Dict[str, Any], results: List[Dict[str, Any]]
 ) -> Dict[str, Any]:
-    qid = cq.get("id") or cq.get("name") or "unnamed"
-    sparql = cq.get("sparql", "")
-    expected = cq.get("expected", None)
-    question = cq.get("question", "")
-    entry: Dict[str, Any] = {
-        "id": qid,
-        "sparql": sparql,
-        "expected": expected,
-        "question": question,
-    }
+    entry = _cq_entry(cq)
+    qid = entry["id"]
+    sparql = entry["sparql"]
+    expected = entry["expected"]
 
     try:
-        res = g.query(sparql)
+        if _native_sparql(g):
+            res = g.query(sparql)
+        else:
+            res = g.query(cq.get("_prepared") or sparql)
     except Exception as e:
         entry.update({"passed": False, "error": str(e), "actual": None})
         # Log this error immediately
@@ -186,33 +487,71 @@ def validate_with_competency_question(
         return entry
 
     # ASK query returns boolean
-    if isinstance(res, bool):
-        actual_bool = res
-        passed = True if expected is None and actual_bool else (expected == actual_bool)
-        entry.update({"passed": passed, "actual": actual_bool})
-        return entry
-
-    # For SELECT queries, collect rows as strings
-    rows = [_row_to_string(r) for r in res]
-    entry["actual"] = rows
-
-    if isinstance(expected, int):
-        passed = len(rows) == expected
-    elif isinstance(expected, list):
+    if res.type == "ASK":
+        return _ask_entry(entry, res.askAnswer)
+
+    # For SELECT queries, only stringify rows when they're compared as a set;
+    # otherwise the row count is all we need
+    if isinstance(expected, list):
+        rows = [_row_to_string(r) for r in res]
+        entry["actual"] = rows
         passed = set(rows) == set(str(x) for x in expected)
     else:
-        # default: pass if any rows returned
-        passed = len(rows) > 0
+        n = sum(1 for _ in res)
+        entry["actual"] = n
+        if isinstance(expected, int):
+            passed = n == expected
+        else:
+            # default: pass if any rows returned
+            passed = n > 0
 
     entry["passed"] = passed
     return entry
 
 
+def _prepare_competency_questions(
+    competency_questions: List[Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """Pre-parse each CQ's SPARQL once and attach it as `_prepared`.
+
+    Plain ASK queries that prepared cleanly also get their group pattern
+    attached as `_ask_body` so they can be fused into a single query.
+
+    CQs that already carry a `_prepared` entry (e.g. from the cached CQ file
+    during the recursive fix loop) are reused as-is. Queries that fail to
+    parse here (e.g. because they rely on prefixes only bound by the graph)
+    are left as raw strings and parsed at query time.
+    """
+    for cq in competency_questions:
+        if "_prepared" in cq:
+            continue
+        try:
+            cq["_prepared"] = prepareQuery(cq.get("sparql", ""))
+        except Exception:
+            cq["_prepared"] = None
+        match = _ASK_QUERY.fullmatch(cq.get("sparql", ""))
+        cq["_ask_body"] = match.group(1) if match and cq["_prepared"] else None
+    return competency_questions
+
+
+# Parsed CQ files keyed by (path, mtime) so repeated runs don't reparse them
+_json_cache: Dict[tuple[str, float], Any] = {}
+
+
 def _load_json(path: str):
+    key = (path, os.path.getmtime(path))
+    if key in _json_cache:
+        return _json_cache[key]
     with open(path, "r", encoding="utf-8") as f:
-        # return json.load(f)
-        return yaml.safe_load(f)
-    
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError:
+            # Not JSON, so treat it as YAML (e.g. cqs_example.yaml)
+            f.seek(0)
+            data = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    _json_cache[key] = data
+    return data
+
 
 def pretty_print_errors(report: Dict[str, Any]) -> str:
     lines: List[str] = []
@@ -243,8 +582,8 @@ def log_report(report: Dict[str, Any], out: Optional[str] = None) -> str:
     lines: List[str] = []
     report_path = os.path.join(out, "validation_report.json")
     try:
-        with open(report_path, "w", encoding="utf-8") as f:
-            json.dump(report, f, indent=2, ensure_ascii=False)
+        with open(report_path, "wb") as f:
+            f.write(_dumps(report, indent=True))
         LOG.info(f"Wrote report to {report_path}")
     except Exception as e:
         LOG.error(f"Failed to write report to {report_path}: {e}")
@@ -275,9 +614,14 @@ def main():
     except Exception:
         # fallback to existing logger
         pass
-    validate_ttl(args.ttl_file)
-    check_consistency(Graph().parse(args.ttl_file, format="turtle"))
-    _, report = validate_with_competency_questions_file(args.ttl_file, args.cqs_file)
+    g = load_graph(args.ttl_file)
+    if g is None:
+        return
+    _, (_, report) = validate_graph(
+        g,
+        load_competency_questions(args.cqs_file),
+        ttl_hash=ttl_sha256(args.ttl_file),
+    )
     # log_report(report, args.out)
 
 